@@ -3,12 +3,12 @@
 #########################################################################
 # Finds all Jira issues in specified projects and in particular states. #
 # Jira statuses are projects could be defined in:                       #
-# - here in the status                                                  #
-# - in files ".statuses" and ".projects"                                #
 # - in env variables JIRA_STATUSES and JIRA_PROJECTS                    #
+# - in files ".statuses" and ".projects"                                #
 # The statuses and projects are read in this order, going down the list #
 # happens only if the previous source returns an empty list/dict of     #
-# projects/statuses.                                                    #
+# projects/statuses, so the files aren't touched if env variables       #
+# are set.                                                              #
 # Statuses are a key:value pair on each line of .statuses file or       #
 # a key:value pair separated by commas in env variable.                 #
 # One projects is on each line of .projects or a you can define a       #
@@ -19,28 +19,64 @@
 
 from requests.auth import HTTPBasicAuth
 from types import MappingProxyType
+from concurrent.futures import ThreadPoolExecutor
 import requests
 import argparse
+import functools
+import importlib.util
 import sys
 import os
+import marshal
+import re
+
+# faster JSON decoding if orjson is installed
+try:
+	from orjson import loads as json_loads
+except ImportError:
+	from json import loads as json_loads
 
 ##############################################################################################################
 
 EMPTY = ''
 
+# returns parse_file(file_name), reusing the result stored in CONFIG_CACHE_FILE_NAME
+# as long as the file's mtime and size and CONFIG_CACHE_VERSION haven't changed
+# marshal is used as it's loaded anyway, so the cache adds no import time
+def read_cached(file_name, parse_file):
+	key = os.path.abspath(file_name)
+	stat = os.stat(file_name)
+	version = (stat.st_mtime, stat.st_size, CONFIG_CACHE_VERSION)
+	cache = {}
+	try:
+		with open(CONFIG_CACHE_FILE_NAME, 'rb') as reader:
+			cache = marshal.load(reader)
+		if cache[key][0] == version:
+			return cache[key][1]
+	except Exception: # missing, stale or corrupt cache
+		pass
+	result = parse_file(file_name)
+	try:
+		cache[key] = (version, result)
+		os.makedirs(os.path.dirname(CONFIG_CACHE_FILE_NAME), exist_ok=True)
+		with open(CONFIG_CACHE_FILE_NAME, 'wb') as writer:
+			marshal.dump(cache, writer)
+	except (OSError, ValueError):
+		pass
+	return result
+
+# key:value line, comments and empty lines don't match
+STATUS_LINE_PATTERN = re.compile(r'^(?!#)([^:\n\r]+):([^\n\r]+?)\s*$', re.M)
+
+def parse_statuses_file(file_name):
+	with open(file_name, 'r') as reader:
+		return dict(STATUS_LINE_PATTERN.findall(reader.read()))
+
 # read Jira statuses from a file
 def read_statuses_from_file(orig_file_name):
 	file_name = orig_file_name.replace('~', os.environ.get("HOME"))
 	if not os.path.isfile(file_name):
-		return statuses
-	with open(file_name, 'r') as reader:
-		statuses = reader.read().split('\n')
-	statuses = [status for status in statuses if len(status)>0 and status[0] != '#']
-	statuses_dict = {}
-	for status in statuses:
-		key, value = status.split(':')
-		statuses_dict[key] = value
-	return statuses_dict
+		return {}
+	return read_cached(file_name, parse_statuses_file)
 
 # read Jira statuses from env variable
 # format: key:value,key1:value1,...keyN:valueN
@@ -53,14 +89,17 @@ def read_statuses_from_env(env_var_name):
 		statuses[key] = value
 	return statuses
 
+def parse_projects_file(file_name):
+	with open(file_name, 'r') as reader:
+		return [line.rstrip() for line in reader
+			if not line.startswith(('#', '\n', '\r'))]
+
 # read Jira projects from a file
 def read_projects_from_file(orig_file_name):
 	file_name = orig_file_name.replace('~', os.environ.get("HOME"))
 	if not os.path.isfile(file_name):
-		return projects
-	with open(file_name, 'r') as reader:
-		projects = reader.read().split('\n')
-	return [project for project in projects if len(project)>0 and project[0] != '#']
+		return []
+	return read_cached(file_name, parse_projects_file)
 
 # read Jira projects from env variable
 # format: project1,project2,...,projectN
@@ -72,6 +111,50 @@ def read_projects_from_env(env_var_name):
 		projects.append(l)
 	return projects
 
+# lazily built, so that --statushelp and --priorityhelp don't pay for what they don't use
+@functools.cache
+def get_auth():
+	return HTTPBasicAuth(JIRA_USER, JIRA_API_KEY)
+
+# HTTP/2 multiplexing of the parallel queries if httpx with h2 is installed,
+# only looked up, httpx is imported in get_session when it's actually used
+@functools.cache
+def use_httpx():
+	return bool(importlib.util.find_spec('httpx') and importlib.util.find_spec('h2'))
+
+# keep-alive connections shared by all queries
+# with httpx the worker threads share a single HTTP/2 connection,
+# which holds only if this is called once before they start (see main)
+# httpx gets no timeout and follows redirects, same as requests, but unlike
+# requests it ignores REQUESTS_CA_BUNDLE (it reads SSL_CERT_FILE instead)
+@functools.cache
+def get_session():
+	if use_httpx():
+		import httpx
+		return httpx.Client(http2=True, auth=(JIRA_USER, JIRA_API_KEY), headers=dict(HEADERS),
+			timeout=None, follow_redirects=True)
+	session = requests.Session()
+	session.auth = get_auth()
+	session.headers.update(HEADERS)
+	return session
+
+# keys are lowercased once here, lookups in main are done with lowercased input
+@functools.cache
+def get_statuses():
+	statuses = read_statuses_from_env(STATUSES_ENV_NAME) or read_statuses_from_file(STATUSES_FILE_NAME)
+	return {k.lower(): v for k, v in statuses.items()}
+
+# double quotes around project names
+@functools.cache
+def get_projects():
+	projects = read_projects_from_env(PROJECTS_ENV_NAME) or read_projects_from_file(PROJECTS_FILE_NAME)
+	return ['"' + i + '"' for i in projects]
+
+# projects joined for JQL, built once per run
+@functools.cache
+def get_projects_jql():
+	return ','.join(get_projects())
+
 def requirements():
 	if not JIRA_API_KEY:
 		print('NO JIRA API KEY present, can\'t proceed.')
@@ -82,7 +165,7 @@ def requirements():
 	if not BASE_API_URL:
 		print('NO BASE API URL present, can\'t proceed.')
 		exit(1)
-	if not AUTH:
+	if not get_auth():
 		print('No auth, can\'t proceed.')
 		exit(1)
 	if not HEADERS:
@@ -91,22 +174,78 @@ def requirements():
 	if not BROWSE_BASE_URL:
 		print('No BROWSE BASE URL specified, can\'t proceed.')
 		exit(1)
-	if not STATUSES:
+	if not get_statuses():
 		print('No STATUSES, can\'t proceed.')
 		exit(1)
-	if not PROJECTS:
+	if not get_projects():
 		print('No PROJECTS, can\'t proceed.')
 		exit(1)
 
-# searches
-def get_test_tickets(env):	
-	query = MappingProxyType({
-		'jql': 'project in ({0}) AND status in ("{1}")'.format(','.join(PROJECTS), env)
-	})
-	response = requests.request("GET", BASE_API_URL + 'search', headers=HEADERS, params=query, auth=AUTH)
-	if response.status_code == 200:
-		return response.json()
-	return None
+# JQL for issues in any of the statuses in any of the projects
+def status_jql(envs):
+	return 'project in ({0}) AND status in ({1})'.format(get_projects_jql(), ','.join(f'"{e}"' for e in envs))
+
+# search request with URL, headers and auth prepared once per run,
+# along with the proxy/TLS settings Session.request would merge on every call
+@functools.cache
+def get_search_request():
+	session = get_session()
+	prepped = session.prepare_request(requests.Request('POST', BASE_API_URL + 'search',
+		headers={'Content-Type': 'application/json'}))
+	return prepped, session.merge_environment_settings(prepped.url, {}, None, None, None)
+
+# POSTs a search query, only the JSON body and cookies change between calls
+# cookies are taken from the session each time, Jira may set them on any response
+def post_search(query):
+	if use_httpx():
+		return get_session().post(BASE_API_URL + 'search', json=query)
+	prepped, settings = get_search_request()
+	prepped = prepped.copy()
+	prepped.headers.pop('Cookie', None)
+	prepped.prepare_cookies(get_session().cookies)
+	prepped.prepare_body(None, None, json=query)
+	return get_session().send(prepped, **settings)
+
+# searches issues in one or more statuses
+# POSTs the query (server may return fewer than PAGE_SIZE issues per page),
+# pages through all results, only fields used in issues_pretty_print are requested,
+# plus the status name so issues of several statuses can be told apart
+# results are cached per statuses for the run, do not modify the returned dict
+@functools.lru_cache(maxsize=128)
+def get_test_tickets(*envs):
+	issues = []
+	start = 0
+	while True:
+		query = {
+			'jql': status_jql(envs),
+			'startAt': start,
+			'maxResults': PAGE_SIZE,
+			'fields': ['summary', 'priority', 'status']
+		}
+		response = post_search(query)
+		if response.status_code != 200:
+			return None
+		page = json_loads(response.content)
+		# keep only what gets printed, so pages can be freed as we go
+		issues.extend((j['key'], j['fields']['priority']['id'], j['fields']['summary'],
+			j['fields']['status']['name']) for j in page['issues'])
+		start += len(page['issues'])
+		if len(page['issues']) == 0 or start >= page['total']:
+			return {'total': page['total'], 'issues': issues}
+
+# only asks for the number of issues, no issues are returned
+# result has the same shape as get_test_tickets' with an empty list of issues
+@functools.lru_cache(maxsize=128)
+def count_test_tickets(env):
+	query = {
+		'jql': status_jql((env,)),
+		'maxResults': 0,
+		'fields': []
+	}
+	response = post_search(query)
+	if response.status_code != 200:
+		return None
+	return {'total': json_loads(response.content)['total'], 'issues': []}
 
 # pretty prints issues
 # adds '!' in front of 'Number of issues: ' if a status_code was != 200
@@ -114,38 +253,77 @@ def issues_pretty_print(result_json):
 	if result_json is None:
 		print('! Number of issues: 0')
 	else:
-		print('Number of issues: {0}'.format(result_json['total']))	
-		for j in result_json['issues']:
-			print('{0} : {1} : {2} : {3}'.format(j['key'], BROWSE_BASE_URL + j['key'],
-				j['fields']['priority']['id'] ,j['fields']['summary']))
+		# one write for all issues instead of a print per issue
+		sys.stdout.write(f"Number of issues: {result_json['total']}\n" + ''.join(
+			f'{key} : {BROWSE_BASE_URL}{key} : {priority} : {summary}\n'
+			for key, priority, summary, *_ in result_json['issues']))
 	
 def main(args):
 	# only prints all Jira statuses to console
 	if args.statushelp:
-		for k, v in STATUSES.items():
-			print(k + ':' + v)
+		for k, v in get_statuses().items():
+			print(f'{k}:{v}')
 		return 0
 
 	# only prints all Jira priorities to console
 	if args.priorityhelp:
 		for k, v in PRIORITY.items():
-			print(k + ':' + v)
+			print(f'{k}:{v}')
 		return 0
 
-	print(','.join(PROJECTS) + '\n')
+	requirements()
+	statuses = get_statuses()
+	# shared by the worker threads, so build it before any of them start,
+	# functools.cache doesn't lock and each thread would build its own
+	get_session()
+	if not use_httpx():
+		get_search_request()
+
+	status = args.status or 'all' # --count-only without -s
+	fetch = count_test_tickets if args.count_only else get_test_tickets
 
-	if args.status.lower() == 'all': # iterate over all test statuses
-		for v in STATUSES.values():
-			print('{0}:'.format(v))
-			issues_pretty_print(get_test_tickets(v))	
+	print(get_projects_jql() + '\n')
+
+	if status.lower() == 'all': # iterate over all test statuses
+		values = list(statuses.values())
+		with ThreadPoolExecutor(max_workers=MAX_WORKERS) as ex:
+			results = list(ex.map(fetch, values))
+		for v, result in zip(values, results):
+			print(f'{v}:')
+			issues_pretty_print(result)
+		return 0
 
 	# create environment list
-	envs = args.status.split(',')
-	for e in envs:
-		e_lower = e.lower()
-		if e_lower in STATUSES: # if such a status exists
-			print('{0}:'.format(STATUSES[e_lower]))
-			issues_pretty_print(get_test_tickets(STATUSES[e_lower]))		
+	envs = status.split(',')
+	values = [statuses[e.lower()] for e in envs if e.lower() in statuses] # if such a status exists
+	if not values:
+		return 0
+	results = None
+	if not args.count_only:
+		# one search for all statuses, issues are then grouped by their status
+		result = get_test_tickets(*dict.fromkeys(values))
+		if result:
+			groups = {v.lower(): [] for v in values}
+			for issue in result['issues']:
+				if issue[3].lower() in groups:
+					groups[issue[3].lower()].append(issue)
+			found = {k: {'total': len(g), 'issues': g} for k, g in groups.items()}
+			# a status whose name Jira returns differently (status id, translated name)
+			# ends up with an empty group, only those are searched one by one
+			if sum(len(g) for g in groups.values()) != result['total']:
+				empty = [v for v in dict.fromkeys(values) if not groups[v.lower()]]
+				with ThreadPoolExecutor(max_workers=MAX_WORKERS) as ex:
+					for v, r in zip(empty, ex.map(fetch, empty)):
+						found[v.lower()] = r
+			# if it still doesn't add up, every status is searched on its own below
+			if all(found.values()) and sum(r['total'] for r in found.values()) == result['total']:
+				results = [found[v.lower()] for v in values]
+	if results is None:
+		with ThreadPoolExecutor(max_workers=MAX_WORKERS) as ex:
+			results = list(ex.map(fetch, values))
+	for v, result in zip(values, results):
+		print(f'{v}:')
+		issues_pretty_print(result)
 
 ##############################################################################################################
 
@@ -153,17 +331,20 @@ JIRA_USER = os.getenv('JIRA_API_USER') or 'pavel.saman@inveo.cz'
 JIRA_API_KEY = os.getenv('JIRA_API_KEY') or None
 BASE_API_URL = 'https://inveocz.atlassian.net/rest/api/3/'
 BROWSE_BASE_URL = 'https://inveocz.atlassian.net/browse/'
-AUTH = HTTPBasicAuth(JIRA_USER, JIRA_API_KEY)
+# no Accept-Encoding here, the default of requests/httpx already asks for gzip
+# (and br/zstd when brotli/zstandard are installed) and decodes it transparently
 HEADERS = MappingProxyType({
    "Accept": "application/json"
 })
+PAGE_SIZE = 1000
+MAX_WORKERS = 8 # parallel requests to Jira
 STATUSES_FILE_NAME = './.statuses'
+CONFIG_CACHE_FILE_NAME = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),
+	'jira-tasks', 'config.marshal')
+CONFIG_CACHE_VERSION = 1 # bump when parse_statuses_file or parse_projects_file change
 PROJECTS_FILE_NAME = './.projects'
 STATUSES_ENV_NAME = 'JIRA_STATUSES'
 PROJECTS_ENV_NAME = 'JIRA_PROJECTS'
-STATUSES = {} or read_statuses_from_file(STATUSES_FILE_NAME) or read_statuses_from_env(STATUSES_ENV_NAME)
-PROJECTS = [] or read_projects_from_file(PROJECTS_FILE_NAME) or read_projects_from_env(PROJECTS_ENV_NAME)
-PROJECTS = ['"' + i + '"' for i in PROJECTS] # double quotes around project names
 PRIORITY = MappingProxyType({
 	1: 'Highest',
 	2: 'High',
@@ -176,9 +357,6 @@ PRIORITY = MappingProxyType({
 
 if __name__ == '__main__':
 
-	# check requirements
-	requirements()
-
 	# arguments
 	parser = argparse.ArgumentParser(description='Show Jira tickets in particular states.')
 	parser.add_argument("-s", "--status", nargs='?', const='all', type=str,
@@ -187,6 +365,8 @@ if __name__ == '__main__':
 		help="Print all Jira statuses.")
 	parser.add_argument("--priorityhelp", action='store_true',
 		help="Print all Jira priorities.")
+	parser.add_argument("--count-only", action='store_true',
+		help="Print only the number of issues in each state.")
 
 	# if no arguments are present
 	if len(sys.argv) == 1: